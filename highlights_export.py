@@ -0,0 +1,284 @@
+"""
+Streams all highlighted and private messages as JSONL to a rotating local file and to a UNIX domain
+socket, so other local programs can consume them without polling logs.
+
+Every event is one JSON object per line with keys: type, network, channel, nick, rank, text,
+timestamp. Events are buffered in memory and written in batches from a timer, so the print hooks
+never wait on disk or on slow consumers. When the buffer or a consumer falls behind, events are
+dropped instead.
+
+Consume the socket for example with:
+    socat - UNIX-CONNECT:$HOME/.highlights_export.sock
+
+HexChat Python Interface: http://hexchat.readthedocs.io/en/latest/script_python.html
+IRC String Formatting: https://github.com/myano/jenni/wiki/IRC-String-Formatting
+"""
+
+import collections
+import json
+import os
+import re
+import socket
+import stat
+import time
+from os import path
+
+import hexchat
+
+__module_name__ = 'highlights_export'
+__module_description__ = 'Streams highlights and private messages as JSONL to a file and a socket'
+__module_version__ = '1.0'
+
+# Set either of these to None to disable that output
+EXPORT_FILE = '~/highlights_export.jsonl'
+EXPORT_SOCKET = '~/.highlights_export.sock'
+
+EXPORT_FILE_MAX_BYTES = 10 * 1024 * 1024
+EXPORT_FILE_BACKUPS = 5
+FLUSH_INTERVAL = 1000  # milliseconds
+BUFFER_MAX_EVENTS = 1000  # events waiting for the next flush
+CLIENT_MAX_BYTES = 256 * 1024  # bytes waiting to be sent to one socket consumer
+
+# Strips IRC colors and formatting, consumers should not need to understand it
+FORMATTING_PATTERN = re.compile(r'\x03(\d{1,2}(,\d{1,2})?)?|[\x02\x0F\x16\x1D\x1F]')
+
+
+class RotatingFile:
+    """
+    Append-only file which is rotated to `name.1`, `name.2`, ... when it grows over the size limit.
+    """
+
+    def __init__(self, filename, max_bytes, backups):
+        self.filename = path.expanduser(filename)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.rotation_failed = False
+        self.file = open(self.filename, 'ab')
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                source = '{}.{}'.format(self.filename, i)
+                if path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.filename, i + 1))
+            if self.backups > 0:
+                os.replace(self.filename, '{}.1'.format(self.filename))
+            else:
+                os.remove(self.filename)
+        finally:
+            self.file = open(self.filename, 'ab')
+
+    def write(self, data):
+        if self.file.closed:  # Reopening after failed rotation failed as well
+            self.file = open(self.filename, 'ab')
+        if self.file.tell() + len(data) > self.max_bytes and self.file.tell() > 0:
+            try:
+                self.rotate()
+                self.rotation_failed = False
+            except OSError as e:
+                # Keep writing into the current file, report only the first failure
+                if not self.rotation_failed:
+                    hexchat.prnt('{}: cannot rotate export file: {}'.format(__module_name__, e))
+                self.rotation_failed = True
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SocketBroadcaster:
+    """
+    Non-blocking UNIX domain socket server which sends the same data to all connected consumers.
+    Consumers which do not read fast enough lose data instead of blocking HexChat.
+    """
+
+    def __init__(self, socket_path, client_max_bytes):
+        self.socket_path = path.expanduser(socket_path)
+        self.client_max_bytes = client_max_bytes
+        self.clients = {}  # socket -> bytearray with data waiting to be sent
+        self.remove_stale_socket()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.setblocking(False)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+
+    def remove_stale_socket(self):
+        """
+        Removes socket left behind by a previous run. Raises `FileExistsError` if the path is not
+        a socket or another process is still listening on it.
+        """
+        try:
+            mode = os.lstat(self.socket_path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError('{} exists and is not a socket'.format(self.socket_path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except ConnectionRefusedError:
+            os.remove(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise FileExistsError('{} is used by another process'.format(self.socket_path))
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            client.setblocking(False)
+            self.clients[client] = bytearray()
+
+    def disconnect(self, client):
+        del self.clients[client]
+        client.close()
+
+    def check_hangups(self):
+        """
+        Disconnects consumers which closed the connection. Anything consumers send is ignored.
+        """
+        for client in list(self.clients):
+            try:
+                if not client.recv(4096):
+                    self.disconnect(client)
+            except BlockingIOError:
+                continue
+            except OSError:
+                self.disconnect(client)
+
+    def send(self, data):
+        """
+        Queues data for all consumers and sends as much as possible without blocking. Returns
+        number of consumers which had to drop the whole batch.
+        """
+        self.accept()
+        self.check_hangups()
+        dropped = 0
+        for client, pending in list(self.clients.items()):
+            if len(pending) + len(data) > self.client_max_bytes:
+                dropped += 1
+            else:
+                pending += data
+            if not pending:
+                continue
+            try:
+                sent = client.send(pending, socket.MSG_NOSIGNAL)
+            except BlockingIOError:
+                continue
+            except OSError:
+                self.disconnect(client)
+                continue
+            del pending[:sent]
+        return dropped
+
+    def close(self):
+        for client in list(self.clients):
+            self.disconnect(client)
+        self.server.close()
+        if path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def on_export_highlight(word, word_eol, userdata):
+    """
+    Callback function which queues the highlighted message for export. It never writes anything
+    itself, so it cannot be slowed down by the outputs.
+    """
+    global dropped_events
+    try:
+        rank = word[2]
+    except IndexError:
+        rank = ''
+    event = {
+        'type': userdata,
+        'network': hexchat.get_info('network'),
+        'channel': hexchat.get_info('channel'),
+        'nick': FORMATTING_PATTERN.sub('', word[0]),
+        'rank': rank,
+        'text': FORMATTING_PATTERN.sub('', word[1]),
+        'timestamp': time.time(),
+    }
+    if len(buffer) >= BUFFER_MAX_EVENTS:
+        dropped_events += 1
+    else:
+        buffer.append(event)
+    return hexchat.EAT_NONE
+
+
+def flush():
+    """
+    Writes all buffered events to the outputs as one batch.
+    """
+    global dropped_batches
+    if not buffer:
+        if broadcaster is not None:
+            broadcaster.send(b'')  # Accept new consumers and send pending data
+        return
+    data = ''.join(json.dumps(buffer.popleft(), ensure_ascii=False) + '\n'
+                   for _ in range(len(buffer))).encode('utf-8')
+    if export_file is not None:
+        try:
+            export_file.write(data)
+        except OSError as e:
+            hexchat.prnt('{}: cannot write export file: {}'.format(__module_name__, e))
+    if broadcaster is not None:
+        dropped_batches += broadcaster.send(data)
+
+
+def on_flush_timer(userdata):
+    flush()
+    return True  # Keep the timer running
+
+
+def on_export_stats(word, word_eol, userdata):
+    """
+    Callback function which prints export statistics.
+
+    Command usage:
+        /export-stats
+    """
+    consumers = len(broadcaster.clients) if broadcaster is not None else 0
+    hexchat.prnt('{}: {} buffered, {} events dropped, {} batches dropped by consumers, '
+                 '{} socket consumers'.format(__module_name__, len(buffer), dropped_events,
+                                              dropped_batches, consumers))
+    return hexchat.EAT_ALL
+
+
+def on_unload(userdata):
+    flush()
+    if export_file is not None:
+        export_file.close()
+    if broadcaster is not None:
+        broadcaster.close()
+    hexchat.prnt('Unloading {}, version {}'.format(__module_name__, __module_version__))
+
+
+buffer = collections.deque()
+dropped_events = 0  # events dropped because the buffer was full
+dropped_batches = 0  # batches dropped by socket consumers which did not keep up
+export_file = None
+broadcaster = None
+
+if EXPORT_FILE is not None:
+    export_file = RotatingFile(EXPORT_FILE, EXPORT_FILE_MAX_BYTES, EXPORT_FILE_BACKUPS)
+if EXPORT_SOCKET is not None:
+    try:
+        broadcaster = SocketBroadcaster(EXPORT_SOCKET, CLIENT_MAX_BYTES)
+    except OSError as e:
+        hexchat.prnt('{}: socket output disabled: {}'.format(__module_name__, e))
+
+hexchat.prnt('{}, version {}'.format(__module_name__, __module_version__))
+hexchat.hook_print('Channel Action Hilight', on_export_highlight, userdata='ACT')
+hexchat.hook_print('Channel Msg Hilight', on_export_highlight, userdata='MSG')
+hexchat.hook_print('Private Message', on_export_highlight, userdata='PVT')
+hexchat.hook_print('Private Message to Dialog', on_export_highlight, userdata='PVD')
+hexchat.hook_print('Private Action to Dialog', on_export_highlight, userdata='PAD')
+hexchat.hook_command('export-stats', on_export_stats)
+hexchat.hook_timer(FLUSH_INTERVAL, on_flush_timer)
+hexchat.hook_unload(on_unload)
@@ -1,9 +1,11 @@
+import collections
 import html
 import logging
+import os
 import re
-import subprocess
+import shlex
+import signal
 import textwrap
-import webbrowser
 
 import dbus.service
 import gi
@@ -29,18 +31,64 @@ sys.excepthook = handle_exception
 HEXCHAT_ICON = '/usr/share/icons/hicolor/scalable/apps/hexchat.svg'
 # ACTIVATE_HEXCHAT_COMMAND = 'move-to-desktop-and-activate 4'
 ACTIVATE_HEXCHAT_COMMAND = 'i3-msg workspace "5:  "'
+OPEN_URL_COMMAND = ['xdg-open']
+ACTION_TIMEOUT = 10  # seconds
 # http://daringfireball.net/2010/07/improved_regex_for_matching_urls
 URL_PATTERN = r'''(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))'''
 
 
+def spawn_async(argv, callback=None, timeout=None):
+    """
+    Run a command without blocking the main loop. If timeout is given, the command is killed if it
+    does not finish in time.
+
+    Args:
+        argv (list): command and its arguments
+        callback (callable): called without arguments when the command finishes or is killed
+        timeout (int): seconds before the command is killed, None to let it run
+    """
+    logging.debug('Spawning command: %s', argv)
+    try:
+        pid, _, _, _ = GLib.spawn_async(argv, flags=GLib.SpawnFlags.SEARCH_PATH |
+                                        GLib.SpawnFlags.DO_NOT_REAP_CHILD)
+    except GLib.Error as e:
+        logging.warning('Spawning command failed: %s', e)
+        if callback:
+            callback()
+        return
+
+    timeout_id = None
+
+    def on_timeout():
+        nonlocal timeout_id
+        logging.warning('Command timed out, killing: %s', argv)
+        timeout_id = None
+        os.kill(pid, signal.SIGKILL)
+        return False
+
+    if timeout is not None:
+        timeout_id = GLib.timeout_add_seconds(timeout, on_timeout)
+
+    def on_exit(pid, status):
+        if timeout_id is not None:
+            GLib.source_remove(timeout_id)
+        GLib.spawn_close_pid(pid)
+        logging.debug('Command finished with status %d: %s', status, argv)
+        if callback:
+            callback()
+
+    GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, on_exit)
+
+
 class ComplexNotification:
     """
-    Class for holding an extension of `Notify.Notification` and managing list of active
-    notifications.
+    Class for holding an extension of `Notify.Notification` and managing registry of active
+    notifications, one per conversation.
     """
-    active_notifications = []
+    active_notifications = collections.OrderedDict()  # (network, channel or nick) -> notification
+    max_notifications = 10
 
-    def __init__(self, nickname, network, channel, title, text, message_type):
+    def __init__(self, nickname, network, channel, message_type):
         """
         This should not be called directly, use `create` class method instead to create references
         to all active notifications.
@@ -48,35 +96,67 @@ class ComplexNotification:
         self.nickname = nickname
         self.network = network
         self.channel = channel
+        self.message_type = message_type
+        self.key = self.conversation_key(nickname, network, channel, message_type)
+
+        self.notification = Notify.Notification.new('', '', HEXCHAT_ICON)
+        self.closed_handler = self.notification.connect('closed', self.on_closed)
+
+    @staticmethod
+    def conversation_key(nickname, network, channel, message_type):
+        """
+        Returns key identifying conversation the message belongs to.
+        """
+        if message_type == 'HLT':
+            return network, channel
+        else:
+            return network, nickname
+
+    @classmethod
+    def create(cls, nickname, network, channel, title, text, message_type):
+        """
+        Show a notification for the message and handle notification registry needed for
+        `Notify.Notification` to be able to call callbacks. Notification already shown for the same
+        conversation is updated in place.
+        """
+        key = cls.conversation_key(nickname, network, channel, message_type)
+        notification = cls.active_notifications.get(key)
+        if notification is None:
+            logging.info('Creating ComplexNotification object')
+            notification = cls(nickname, network, channel, message_type)
+            cls.active_notifications[key] = notification
+            if len(cls.active_notifications) > cls.max_notifications:
+                _, evicted = cls.active_notifications.popitem(last=False)
+                evicted.notification.close()
+                evicted.release()
+        else:
+            logging.info('Updating ComplexNotification object')
+            cls.active_notifications.move_to_end(key)
+        notification.show(nickname, channel, title, text)
+        logging.debug('Notification list: %d', len(cls.active_notifications))
+
+    def show(self, nickname, channel, title, text):
+        """
+        Show the message, replacing content of already shown notification.
+        """
+        self.nickname = nickname
+        self.channel = channel
         self.title = title
         self.text = html.escape(text)  # Display all characters as is
-        self.message_type = message_type
 
         self.url = self.find_url()
         if self.url:
             self.text = self.text.replace(self.url, '<u>' + self.url + '</u>')
         self.wrapped_text = textwrap.fill(self.text, 60)
 
-        self.notification = Notify.Notification.new(self.title, self.wrapped_text, HEXCHAT_ICON)
+        self.notification.update(self.title, self.wrapped_text, HEXCHAT_ICON)
+        self.notification.clear_actions()
         self.notification.add_action('clicked_dismiss', 'Dismiss all', self.on_dismiss)
         if self.url:
             self.notification.add_action('clicked_follow', 'Follow link', self.on_follow)
         self.notification.add_action('clicked_show', 'Show me', self.on_show)
         self.notification.show()
 
-    @classmethod
-    def create(cls, nickname, network, channel, title, text, message_type):
-        """
-        Create a new notification and handle notification reference list needed for
-        `Notify.Notification` to be able to call callbacks.
-        """
-        logging.info('Creating ComplexNotification object')
-        notification = cls(nickname, network, channel, title, text, message_type)
-        cls.active_notifications.append(notification)
-        if len(cls.active_notifications) > 10:
-            del cls.active_notifications[0]
-        logging.debug('Notification list: %d', len(cls.active_notifications))
-
     @staticmethod
     def get_hexchat_interface():
         """
@@ -86,8 +166,9 @@ class ComplexNotification:
             dbus.proxies.Interface: HexChat DBus interface object
         """
         session_bus = dbus.SessionBus()
+        # Introspection would be another blocking call to HexChat
         dbus_object = session_bus.get_object(bus_name='org.hexchat.service',
-                                             object_path='/org/hexchat/Remote')
+                                             object_path='/org/hexchat/Remote', introspect=False)
         interface = dbus.Interface(object=dbus_object, dbus_interface='org.hexchat.plugin')
         return interface
 
@@ -105,37 +186,72 @@ class ComplexNotification:
 
     def activate_hexchat(self):
         """
-        Activate HexChat application and move to correct tab.
+        Activate HexChat application and move to correct tab once it is activated.
         """
         logging.debug('Activate HexChat application')
-        subprocess.call(ACTIVATE_HEXCHAT_COMMAND, shell=True)
+        # Run without shell, so the timeout kills the command itself and not only the shell
+        spawn_async(shlex.split(ACTIVATE_HEXCHAT_COMMAND), callback=self.switch_tab,
+                    timeout=ACTION_TIMEOUT)
 
+    def switch_tab(self):
+        """
+        Move HexChat to the tab where the message arrived. All calls to HexChat are asynchronous,
+        as HexChat may be blocked sending a new notification to this server.
+        """
         interface = self.get_hexchat_interface()
-        context = interface.FindContext(self.network, self.channel)
-        interface.SetContext(context)
-        if self.message_type == 'HLT':
-            logging.debug('Move to channel: %s', self.channel)
-            interface.Command('join {}'.format(self.channel))
-        else:
-            logging.debug('Move to private: %s', self.nickname)
-            interface.Command('query {}'.format(self.nickname))
+
+        def on_context_set():
+            if self.message_type == 'HLT':
+                logging.debug('Move to channel: %s', self.channel)
+                interface.Command('join {}'.format(self.channel), ignore_reply=True)
+            else:
+                logging.debug('Move to private: %s', self.nickname)
+                interface.Command('query {}'.format(self.nickname), ignore_reply=True)
+
+        def on_context_found(context):
+            interface.SetContext(context, reply_handler=on_context_set,
+                                 error_handler=self.on_hexchat_error)
+
+        interface.FindContext(self.network, self.channel, reply_handler=on_context_found,
+                              error_handler=self.on_hexchat_error)
+
+    @staticmethod
+    def on_hexchat_error(error):
+        logging.warning('DBus call to HexChat failed: %s', error)
 
     def on_dismiss(self, notification, action_name):
         logging.info('Action: dismiss')
-        for complex_notification in self.active_notifications:
+        for complex_notification in list(self.active_notifications.values()):
             complex_notification.notification.close()
         self.active_notifications.clear()
         logging.debug('Notification list: %d', len(self.active_notifications))
 
         interface = self.get_hexchat_interface()
         logging.debug('Reset icon')
-        interface.Command('TRAY -f {}'.format(HEXCHAT_ICON))
+        interface.Command('TRAY -f {}'.format(HEXCHAT_ICON), ignore_reply=True)
+
+    def release(self):
+        """
+        Drop callbacks held by `Notify.Notification`. They reference this object from C, so
+        without this the object is never garbage collected.
+        """
+        self.notification.clear_actions()
+        if self.closed_handler is not None:
+            self.notification.disconnect(self.closed_handler)
+            self.closed_handler = None
+
+    def on_closed(self, notification):
+        logging.debug('Notification closed: %s', self.key)
+        if self.active_notifications.get(self.key) is self:
+            del self.active_notifications[self.key]
+        self.release()
+        logging.debug('Notification list: %d', len(self.active_notifications))
 
     def on_follow(self, notification, action_name):
         logging.info('Action: follow | %s | => also show', self.url)
         self.on_show(None, None)
         logging.debug('Opening URL in web browser | %s', self.url)
-        webbrowser.open_new_tab(self.url)
+        spawn_async(OPEN_URL_COMMAND + [self.url])
 
     def on_show(self, notification, action_name):
         logging.info('Action: show | %s', [self.nickname, self.network, self.channel,